@@ -24,13 +24,15 @@ Lomonosov Moscow State University,
 Biological Faculty, room 330
 '''
 
-import sys, random, os, argparse, time
+import sys, random, os, argparse, time, mmap, io, re
 from collections import defaultdict
+from functools import partial
+from itertools import compress
 
 # try importing termcolor module
 has_termcolor = True
 try:
-    from termcolor import colored, cprint
+    from termcolor import COLORS, HIGHLIGHTS, ATTRIBUTES
 
 except ImportError:
     has_termcolor = False
@@ -53,169 +55,308 @@ font_styles = {
     'motif_attrs'     : ['underline']
 }
 
+def _ansi_codes(message_type, styles = font_styles):
+    """ escape sequences termcolor puts around text of given type """
+
+    # built from termcolor tables in the order colored() nests them, so no
+    # runtime TTY check of sys.stdout is involved
+    prefix = ''
+    color = styles.get('{}_fg'.format(message_type))
+    if color is not None:
+        prefix = '\033[{}m'.format(COLORS[color]) + prefix
+    on_color = styles.get('{}_bg'.format(message_type))
+    if on_color is not None:
+        prefix = '\033[{}m'.format(HIGHLIGHTS[on_color]) + prefix
+    for attr in styles.get('{}_attrs'.format(message_type)) or []:
+        prefix = '\033[{}m'.format(ATTRIBUTES[attr]) + prefix
+
+    return prefix, '\033[0m'
+
+# coloring is reduced to plain string concatenation on the output paths
+message_types = ['text', 'info', 'highlight', 'infored', 'marked', 'motif']
+ansi_prefix = dict.fromkeys(message_types, '')
+ansi_suffix = dict.fromkeys(message_types, '')
+if has_termcolor:
+    for message_type in message_types:
+        ansi_prefix[message_type], ansi_suffix[message_type] = _ansi_codes(message_type)
+
+def _use_color(stream):
+    """ colors only for terminal streams, unless disabled by environment """
+
+    # same switches termcolor itself honours
+    return has_termcolor and not os.environ.get('NO_COLOR') and not os.environ.get('ANSI_COLORS_DISABLED') and stream.isatty()
+
 default_output_dest = sys.stdout
+# size of byte buffer collected by write_fasta before each write call
+_WRITE_CHUNK_SIZE = 1 << 20
 
 '''
     WRITERS
 '''
-def printer(what, message_type = 'text', newline = True, stream = default_output_dest, has_termcolor = has_termcolor, styles = font_styles):
+def printer(what, message_type = 'text', newline = True, stream = default_output_dest, use_color = None):
     """ general function to print output """
 
-    if has_termcolor:
-        what = colored(what, color = styles['{}_fg'.format(message_type)], on_color = styles['{}_bg'.format(message_type)], attrs = styles['{}_attrs'.format(message_type)])
-
-    line_ending = '\n'
-    if newline == False:
-        line_ending = ''
+    # callers on hot paths pass use_color decided once, others get it per call
+    if use_color is None:
+        use_color = _use_color(stream)
 
-#    elif newline == 'Windows':
-#        line_ending = '\r\n'
+    if use_color:
+        what = ansi_prefix[message_type] + str(what) + ansi_suffix[message_type]
 
-    stream.writelines('{}{}'.format(what, line_ending))
+    stream.write(str(what))
+    if newline:
+        stream.write('\n')
 
 
-def write_fasta(fasta_entries, stream = default_output_dest):
+def write_fasta(names, seqs, stream = default_output_dest, use_color = None):
     """ default output of processed data """
 
-    for i in range(len(fasta_entries)):
-        printer('>', message_type = 'highlight', newline = False, stream=stream)
-        printer(fasta_entries[i][0], message_type = 'info', stream=stream)
-        printer(fasta_entries[i][1], message_type = 'text', stream=stream)
+    # colors are only useful on a terminal, plain text is encoded into
+    # a byte buffer and passed to the binary stream in large chunks
+    if use_color is None:
+        use_color = _use_color(stream)
+
+    if use_color or not hasattr(stream, 'buffer'):
+        # escape codes are looked up once, loop only concatenates locals
+        parts = []
+        parts_append = parts.append
+        if use_color:
+            header_mark = ansi_prefix['highlight'] + '>' + ansi_suffix['highlight'] + ansi_prefix['info']
+            header_end = ansi_suffix['info'] + '\n' + ansi_prefix['text']
+            seq_end = ansi_suffix['text'] + '\n'
+        else:
+            header_mark, header_end, seq_end = '>', '\n', '\n'
+
+        for name, seq in zip(names, seqs):
+            parts_append(header_mark + name + header_end + seq + seq_end)
+
+        stream.write(''.join(parts))
+        return
+
+    encoding = stream.encoding or 'utf-8'
+    binary_write = stream.buffer.write
+    chunk_size = _WRITE_CHUNK_SIZE
+    stream.flush()
+    buf = bytearray()
+    for name, seq in zip(names, seqs):
+        buf += b'>'
+        buf += name.encode(encoding)
+        buf += b'\n'
+        buf += seq.encode(encoding)
+        buf += b'\n'
+        if len(buf) > chunk_size:
+            binary_write(buf)
+            buf.clear()
+
+    binary_write(buf)
+    stream.buffer.flush()
 
 
 '''
     READERS
 '''
+# line ending bytes deleted from sequence data
+_STRIP_NL = b'\r\n'
+# carriage return not followed by newline, classic Mac line ending
+_LONE_CR = re.compile(b'\r(?!\n)')
+
+def _universal_lines(fasta_handle):
+    """ yields lines of binary handle split as text mode would split them """
+
+    # binary lines end only at \n; a lone \r (classic Mac line ending)
+    # also ends a line in text mode, so such lines are split further
+    for line in fasta_handle:
+        if line.count(b'\r') > line.endswith(b'\r\n'):
+            yield from line.splitlines(True)
+        else:
+            yield line
+
 def fasta_reader(fasta_handle):
-    """ reads .fasta into list """
+    """ reads .fasta into parallel lists of names and sequences """
 
-#    Fast version of .fasta reader uses Tanya's .replace() hack to remove \r, \n
-#    from the sequence string and join() to create initial sequence string
+#    Fast version of .fasta reader uses bytes.translate() to remove \r, \n
+#    from the sequence bytes and join() to create initial sequence string
 #    from list
 #    Function reads fasta entries as is, does not split anything
 
-    fasta_lines  = fasta_handle.readlines()
-    # add dummy entry at the end of the data to trigger last round of
-    # sequence_accu insertion
-    fasta_lines += ['>\n']
-    fasta_entries = []
+    # handle is binary and read lazily, line by line, to keep memory
+    # footprint low; each sequence is decoded once after joining
+    names = []
+    seqs = []
     sequence_accu = []
-    for line in fasta_lines:
-        if line[0] == '>':
+    for line in _universal_lines(fasta_handle):
+        if line.startswith(b'>'):
             if len(sequence_accu) > 0:
-                # fast sequence string formatting
-                fasta_entries[-1][1] = ''.join(sequence_accu).replace('\n', '').replace('\r', '')
+                # lines before the first header belong to no entry and are
+                # skipped, fast sequence string formatting otherwise
+                if seqs:
+                    seqs[-1] = b''.join(sequence_accu).translate(None, _STRIP_NL).decode()
                 sequence_accu = []
 
-            fasta_entries.append([line[1:].strip(), ''])
+            names.append(line[1:].strip().decode())
+            seqs.append('')
 
         else:
             sequence_accu.append(line)
 
-    # return everything except dummy entry
-    return fasta_entries[:-1]
+    # last entry is finalized at the end of the data
+    if sequence_accu and seqs:
+        seqs[-1] = b''.join(sequence_accu).translate(None, _STRIP_NL).decode()
+
+    return names, seqs
+
+
+def fasta_mmap_reader(fasta_buffer):
+    """ reads memory mapped .fasta into parallel lists of names and sequences """
+
+#    Records are located with find() calls over the whole buffer, so no
+#    Python level loop over lines is needed. Like fasta_reader(), lines
+#    before the first header are skipped
 
+    # lone \r (classic Mac) line endings are rare, such data is handed over
+    # to the line reader, which splits them like text mode does
+    if fasta_buffer.find(b'\r') >= 0 and _LONE_CR.search(fasta_buffer):
+        return fasta_reader(io.BytesIO(fasta_buffer))
 
-def load_filter_dict(input_file):
+    names = []
+    seqs = []
+    buffer_len = len(fasta_buffer)
+    if fasta_buffer[:1] == b'>':
+        pos = 0
+    else:
+        pos = fasta_buffer.find(b'\n>')
+        pos = buffer_len if pos < 0 else pos + 1
+
+    while pos < buffer_len:
+        # record spans from its '>' up to the next line starting with '>'
+        next_pos = fasta_buffer.find(b'\n>', pos)
+        end = buffer_len if next_pos < 0 else next_pos + 1
+        header_end = fasta_buffer.find(b'\n', pos, end)
+        if header_end < 0:
+            header_end = end
+
+        names.append(fasta_buffer[pos + 1:header_end].strip().decode())
+        seqs.append(fasta_buffer[header_end:end].translate(None, _STRIP_NL).decode())
+        pos = end
+
+    return names, seqs
+
+
+def load_filter_set(input_file):
     """ reads list file for filtering """
 
-    filter_dict = {}
+    filter_set = set()
     with open(input_file, 'r') as ifile:
         for line in ifile:
             filter_item = line.strip()
-            if filter_item[0] == '>':
+            if not filter_item:
+                continue
+
+            if filter_item.startswith('>'):
                 filter_item = filter_item[1:]
 
-            filter_dict[filter_item] = 1
+            filter_set.add(filter_item)
 
-    return filter_dict
+    return filter_set
 
 
 '''
     SUPPORTED OPERATIONS SECTION
 '''
-def EntryUppercase(input_entries, **options):
+def EntryUppercase(names, seqs):
     """ all sequence uppercase """
 
-    for i in range(len(input_entries)):
-        input_entries[i][1] = input_entries[i][1].upper()
+    seqs[:] = map(str.upper, seqs)
 
-def EntryLowercase(input_entries, **options):
+def EntryLowercase(names, seqs):
     """ all sequence lowercase """
 
-    for i in range(len(input_entries)):
-        input_entries[i][1] = input_entries[i][1].lower()
+    seqs[:] = map(str.lower, seqs)
 
-def ListRemove(input_entries, **options):
-    """ remove listed sequences """
+def _filter_entries(names, seqs, filter_set, keep):
+    """ keeps (or drops) entries listed in filter_set, in place """
 
-    filter = options.get('filter_dict')
-    filtered_entries = []
-    for i in range(len(input_entries)):
-        if input_entries[i][0] not in filter:
-            filtered_entries.append(input_entries[i])
+    # compress() selects kept items in C; slice assignment still collects
+    # each iterator into a temporary list before replacing list contents
+    keep_mask = [(name in filter_set) is keep for name in names]
+    names[:] = compress(names, keep_mask)
+    seqs[:] = compress(seqs, keep_mask)
 
-    input_entries[:] = list(filtered_entries)
+def ListRemove(names, seqs, filter_set):
+    """ remove listed sequences """
 
-def ListKeep(input_entries, **options):
-    """ keep listed sequences """
+    _filter_entries(names, seqs, filter_set, False)
 
-    filter = options.get('filter_dict')
-    filtered_entries = []
-    for i in range(len(input_entries)):
-        if input_entries[i][0] in filter:
-            filtered_entries.append(input_entries[i])
+def ListKeep(names, seqs, filter_set):
+    """ keep listed sequences """
 
-    input_entries[:] = list(filtered_entries)
+    _filter_entries(names, seqs, filter_set, True)
 
-def InfoN50(input_entries, **options):
+def InfoN50(names, seqs, use_color = None):
     """ only output N50 of .fasta provided """
 
-    total_len = 0
-    for i in range(len(input_entries)):
-        input_entries[i].append(len(input_entries[i][1]))
-        total_len += input_entries[i][-1]
+    # lengths are kept in a scratch list, entries are never touched; N50
+    # entry is the first one in descending length order where the running
+    # sum exceeds half of total length
+    lens = list(map(len, seqs))
+    half_len = sum(lens) // 2
 
     running_sum = 0
-    for i in sorted(input_entries, key = lambda x : x[2], reverse = True):
-        running_sum += i[2]
-        if running_sum > total_len / 2:
-            printer('N50\t', message_type = 'info', newline = False)
-            printer(i[2], message_type = 'info', newline = False)
-            printer('\t', newline = False)
-            printer(i[0])
+    for i in sorted(range(len(lens)), key = lens.__getitem__, reverse = True):
+        running_sum += lens[i]
+        if running_sum > half_len:
+            printer('N50\t', message_type = 'info', newline = False, use_color = use_color)
+            printer(lens[i], message_type = 'info', newline = False, use_color = use_color)
+            printer('\t', newline = False, use_color = use_color)
+            printer(names[i], use_color = use_color)
             # EXIT point, nothing to be done
             exit(0)
 
 
-def InfoEntryLength(input_entries, **options):
+def InfoEntryLength(names, seqs, use_color = None):
     """ print length of each entry as table """
 
-    for i in range(len(input_entries)):
-        printer(input_entries[i][0], newline = False, message_type = 'text')
-        printer('\t', newline = False, message_type = 'text')
-        printer(len(input_entries[i][1]), newline = True, message_type = 'info')
+    if use_color is None:
+        use_color = _use_color(sys.stdout)
+
+    if use_color:
+        for name, seq in zip(names, seqs):
+            printer(name, newline = False, message_type = 'text', use_color = True)
+            printer('\t', newline = False, message_type = 'text', use_color = True)
+            printer(len(seq), newline = True, message_type = 'info', use_color = True)
+
+    else:
+        # plain table is encoded into one buffer and written at once
+        encoding = sys.stdout.encoding or 'utf-8'
+        buf = bytearray()
+        for name, seq in zip(names, seqs):
+            buf += name.encode(encoding)
+            buf += b'\t'
+            buf += str(len(seq)).encode(encoding)
+            buf += b'\n'
+
+        sys.stdout.flush()
+        sys.stdout.buffer.write(buf)
+        sys.stdout.buffer.flush()
+
     # EXIT point, nothing to be done
     exit(0)
 
-def EntryRenumerate(input_entries, **options):
+def EntryRenumerate(names, seqs, prefix = 'seq'):
     """ Renames entries using prefix and increment """
 
-    increment = 0
-    prefix = options.get('prefix')
-    for i in range(len(input_entries)):
-        increment += 1
-        input_entries[i][0] = prefix + str(increment)
+    names[:] = [prefix + str(increment) for increment in range(1, len(names) + 1)]
 
+# each action lists the run options bound to it before the call
 ACTIONS = {
-'upper'  :    EntryUppercase,          # action:  upper
-'lower'  :    EntryLowercase,          # action:  lower
-'remove' :    ListRemove,              # action:  remove     [needs --list]
-'keep'   :    ListKeep,                # action:  keep       [needs --list]
-'renumerate' :    EntryRenumerate,             # action: renumerate  [uses  --prefix]
-'N50'    :    InfoN50,                 # action: N50
-'len'    :    InfoEntryLength,         # action: len
-#'rc'     :    EntryRecvom
+'upper'  :    (EntryUppercase, ()),                  # action:  upper
+'lower'  :    (EntryLowercase, ()),                  # action:  lower
+'remove' :    (ListRemove, ('filter_set',)),         # action:  remove     [needs --list]
+'keep'   :    (ListKeep, ('filter_set',)),           # action:  keep       [needs --list]
+'renumerate' :    (EntryRenumerate, ('prefix',)),    # action: renumerate  [uses  --prefix]
+'N50'    :    (InfoN50, ('use_color',)),             # action: N50
+'len'    :    (InfoEntryLength, ('use_color',)),     # action: len
+#'rc'     :    (EntryRecvom, ())
 }
 
 
@@ -239,16 +380,21 @@ if __name__ == '__main__':
 
     run_args = TfamOptionsParser.parse_args(sys.argv[1:])
 
-    input_source = sys.stdin
+    input_source = sys.stdin.buffer
     if run_args.fasta is not None:
         if os.path.isfile(run_args.fasta):
-            input_source = open(run_args.fasta, 'r')
-
-    fasta_data = fasta_reader(input_source)
-    filter_dict = {}
+            input_source = open(run_args.fasta, 'rb')
+
+    if input_source is not sys.stdin.buffer and os.fstat(input_source.fileno()).st_size > 0:
+        # regular input file is mapped to memory instead of read by lines
+        with mmap.mmap(input_source.fileno(), 0, access = mmap.ACCESS_READ) as fasta_map:
+            names, seqs = fasta_mmap_reader(fasta_map)
+    else:
+        names, seqs = fasta_reader(input_source)
+    filter_set = set()
     if run_args.list is not None:
         if os.path.isfile(run_args.list):
-            filter_dict = load_filter_dict(run_args.list)
+            filter_set = load_filter_set(run_args.list)
 
     output_dest = sys.stdout
     output_is_file = False
@@ -256,6 +402,11 @@ if __name__ == '__main__':
         output_dest = open(run_args.out, 'w')
         output_is_file = True
 
+    # colors are decided once per stream: .fasta goes to output_dest, while
+    # info actions always print to stdout; files are never colored
+    fasta_use_color = _use_color(output_dest)
+    use_color = _use_color(sys.stdout)
+
     if run_args.action is None:
         printer('Error! Argument "--action" is mandatory\n', message_type = 'marked', stream = sys.stderr)
         exit(1)
@@ -264,12 +415,15 @@ if __name__ == '__main__':
         prefix = run_args.prefix
 
     options = {
-        'filter_dict' : filter_dict,
-        'prefix' : prefix
+        'filter_set' : filter_set,
+        'prefix' : prefix,
+        'use_color' : use_color
     }
 
-    action_func = ACTIONS[run_args.action]
-    action_func(fasta_data, **options)
-    write_fasta(fasta_data, output_dest)
+    # options are bound to the selected action once, it is called positionally
+    action_func, action_option_names = ACTIONS[run_args.action]
+    action_func = partial(action_func, **{name : options[name] for name in action_option_names})
+    action_func(names, seqs)
+    write_fasta(names, seqs, output_dest, fasta_use_color)
     if output_is_file:
         output_dest.close()